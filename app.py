@@ -1,18 +1,87 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 import os
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
+import codecs
+import gzip
+import hashlib
 import re
 import time
+from collections import OrderedDict
+from itertools import chain
+from threading import Lock
+from urllib.parse import urlsplit, urlunsplit
 
 load_dotenv()
 
+
+# Flask JSON provider backed by orjson for request parsing and jsonify
+class ORJSONProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 # Enable CORS for all routes so the frontend can communicate with it
 CORS(app)
 
+# Keep-alive sessions: one for the Gemini/DeepSeek APIs, one for crawling user links,
+# so slow third-party pages never hold connections the API calls need
+API_SESSION = requests.Session()
+# Sized for gevent workers with many in-flight Gemini calls; transient 429/5xx are retried with backoff
+API_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(
+        total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"], raise_on_status=False,
+    ),
+))
+
+CRAWL_SESSION = requests.Session()
+CRAWL_SESSION.headers.update({'User-Agent': 'Mozilla/5.0'})
+_crawl_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50)
+CRAWL_SESSION.mount("https://", _crawl_adapter)
+CRAWL_SESSION.mount("http://", _crawl_adapter)
+# Outbound bodies are pre-serialized with orjson and sent as data=
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Environment is fixed after startup, so read keys and config once at import
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:streamGenerateContent?alt=sse"
+# Gemini bodies are mostly persona prose and chat history, so gzip them before upload.
+# The key goes in a header built once here, so URLs need no per-call encoding and error messages never include it.
+GEMINI_HEADERS = {**JSON_HEADERS, "Content-Encoding": "gzip", "x-goog-api-key": GEMINI_API_KEY or ""}
+
+def gemini_body(payload):
+    return gzip.compress(orjson.dumps(payload), compresslevel=1)
+
+# Served verbatim by /config
+_CONFIG_BODY = orjson.dumps({
+    "apiKey": os.environ.get("FIREBASE_API_KEY", ""),
+    "authDomain": os.environ.get("FIREBASE_AUTH_DOMAIN", ""),
+    "projectId": os.environ.get("FIREBASE_PROJECT_ID", ""),
+    "storageBucket": os.environ.get("FIREBASE_STORAGE_BUCKET", ""),
+    "messagingSenderId": os.environ.get("FIREBASE_MESSAGING_SENDER_ID", ""),
+    "appId": os.environ.get("FIREBASE_APP_ID", ""),
+})
+
 # -------------------------------------------------------
 # HOME & CONFIG ROUTES
 # -------------------------------------------------------
@@ -22,64 +91,136 @@ def home():
 
 @app.route("/config", methods=["GET"])
 def get_config():
-    try:
-        return jsonify({
-            "apiKey": os.environ.get("FIREBASE_API_KEY", ""),
-            "authDomain": os.environ.get("FIREBASE_AUTH_DOMAIN", ""),
-            "projectId": os.environ.get("FIREBASE_PROJECT_ID", ""),
-            "storageBucket": os.environ.get("FIREBASE_STORAGE_BUCKET", ""),
-            "messagingSenderId": os.environ.get("FIREBASE_MESSAGING_SENDER_ID", ""),
-            "appId": os.environ.get("FIREBASE_APP_ID", ""),
-        })
-    except Exception as e:
-        return jsonify({"error": f"Config error: {e}"}), 500
+    return Response(_CONFIG_BODY, mimetype="application/json", headers={"Cache-Control": "public, max-age=3600"})
 
 # -------------------------------------------------------
 # URL SCRAPER UTILS
 # -------------------------------------------------------
+# normalized url -> (fetched_at, ttl, etag, text, ok), oldest entry first; failures are kept briefly too
+_crawl_cache = OrderedDict()
+_crawl_lock = Lock()
+CRAWL_CACHE_SIZE = 512
+CRAWL_CACHE_TTL = 3600
+CRAWL_ERROR_TTL = 60
+CRAWL_MAX_BYTES = 256 * 1024
+
+_CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.I)
+# <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+_META_CHARSET_RE = re.compile(r'<meta[^>]+charset=["\']?([\w.:-]+)', re.I)
+
+def _header_charset(ctype):
+    match = _CHARSET_RE.search(ctype)
+    return match.group(1) if match else None
+
+def _decode(content, *encodings):
+    # First known codec wins; UTF-8 is the final fallback
+    for encoding in (*encodings, 'utf-8'):
+        if not encoding:
+            continue
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            continue
+        return content.decode(encoding, errors='replace')
+
+def _decode_html(content, ctype):
+    # Lexbor assumes UTF-8 bytes, so honour the header charset, then <meta charset>, before parsing
+    head = content[:4096].decode('ascii', errors='ignore')
+    meta = _META_CHARSET_RE.search(head)
+    return _decode(content, _header_charset(ctype), meta.group(1) if meta else None)
+
+def _page_text(content, ctype=''):
+    tree = LexborHTMLParser(_decode_html(content, ctype))
+    # Only <body> text is returned, so leave <head> untouched
+    root = tree.body or tree.root
+    for tag in root.css("script, style, noscript, svg, nav, footer, header"):
+        tag.decompose()
+    # Lexbor still joins whitespace-only text nodes, so collapse the runs before spending the budget
+    return " ".join(root.text(separator=' ', strip=True).split())[:10000]
+
+def _crawl_cache_key(url):
+    # Fragments never reach the server and hosts are case-insensitive, so fold those variants together
+    parts = urlsplit(url)
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+def _cache_crawl(key, ttl, etag, text, ok=True):
+    with _crawl_lock:
+        _crawl_cache[key] = (time.time(), ttl, etag, text, ok)
+        _crawl_cache.move_to_end(key)
+        while len(_crawl_cache) > CRAWL_CACHE_SIZE:
+            _crawl_cache.popitem(last=False)
+
 def crawl_specific_url(url):
+    key = cached = None
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, 'html.parser')
-        for tag in soup(["script", "style", "nav", "footer", "header"]):
-            tag.decompose()
-        return soup.get_text(separator=' ', strip=True)[:10000]
+        # urlsplit raises ValueError on malformed hosts such as "http://[::1/x"
+        key = _crawl_cache_key(url)
+        with _crawl_lock:
+            cached = _crawl_cache.get(key)
+            if cached:
+                _crawl_cache.move_to_end(key)
+        if cached and time.time() - cached[0] < cached[1]:
+            return cached[3]
+        etag = cached[2] if cached else None
+        # Stale entries are revalidated with their ETag so an unchanged page skips the parse
+        headers = {'If-None-Match': etag} if etag else {}
+        with CRAWL_SESSION.get(url, headers=headers, timeout=10, stream=True) as response:
+            if etag and response.status_code == 304:
+                etag, text = response.headers.get('ETag', etag), cached[3]
+            else:
+                response.raise_for_status()
+                ctype = response.headers.get('Content-Type', '').lower()
+                if ctype and not (ctype.startswith('text/') or 'json' in ctype or 'xml' in ctype):
+                    # PDFs, images etc. have no text to extract, so don't download them at all
+                    raise ValueError(f"unsupported content type {ctype}")
+                # Only the first 10000 chars of text are kept, so stop reading after CRAWL_MAX_BYTES
+                buf = bytearray()
+                for chunk in response.iter_content(65536):
+                    buf.extend(chunk)
+                    if len(buf) >= CRAWL_MAX_BYTES:
+                        break
+                content = bytes(buf[:CRAWL_MAX_BYTES])
+                if ctype and 'html' not in ctype:
+                    # JSON, plain text, markdown etc. are already readable, so skip the HTML parse
+                    # requests assumes ISO-8859-1 for text/* without a charset, so only trust an explicit one
+                    text = _decode(content, _header_charset(ctype))[:10000]
+                else:
+                    text = _page_text(content, ctype)
+                etag = response.headers.get('ETag')
+        _cache_crawl(key, CRAWL_CACHE_TTL, etag, text)
+        return text
     except Exception as e:
-        return f"Error crawling {url}: {str(e)}"
+        if cached and cached[4]:
+            # Revalidation of a good page failed: keep serving it (and its ETag) for a short while
+            _cache_crawl(key, CRAWL_ERROR_TTL, cached[2], cached[3])
+            return cached[3]
+        # Remember the failure briefly so repeats of a dead or slow link don't wait out the timeout again
+        text = f"Error crawling {url}: {str(e)}"
+        if key is not None:
+            _cache_crawl(key, CRAWL_ERROR_TTL, None, text, ok=False)
+        return text
+
+# RFC 3986 URL characters, minus trailing sentence punctuation
+_URL_RE = re.compile(r"https?://[A-Za-z0-9\-._~:/?#@!$&'()*+,;=%]+(?<![.,;:!?'])")
 
 def extract_url(text):
-    match = re.search(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-f_A-F][0-9a-f_A-F]))+', text)
+    # Every match contains "://", so skip the regex for messages without it
+    if "://" not in text:
+        return None
+    match = _URL_RE.search(text)
     return match.group(0) if match else None
 
 # -------------------------------------------------------
-# MAIN AI ENDPOINT
+# PERSONA BUILDER
 # -------------------------------------------------------
-@app.route("/ask", methods=["POST"])
-def ask_ai():
-    data = request.get_json()
-    history = data.get("history", [])
-    
-    # Mode Toggles
-    use_web_search = data.get("useWebSearch", False)
-    use_think_mode = data.get("useThinkMode", False)
-    use_study_mode = data.get("useStudyMode", False)
-
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    deepseek_api_key = os.getenv("DEEPSEEK_API_KEY")
-
-    # ---------------------------------------------------
-    # PERSONA BUILDER
-    # ---------------------------------------------------
-    base_persona = """
+# Built once at import; /ask only appends the per-request link context
+BASE_PERSONA = """
     You are Lumina, a highly intelligent, warm, and creative AI assistant created EXCLUSIVELY by Gholam Panjetan Khan.
     ⚠️ IDENTITY RULES: Never say you are made by Google, OpenAI, DeepMind, etc.
     🧠 PERSONALITY: Friendly, smart, engaging. Use emojis and structured formatting.
     """
 
-    if use_study_mode:
-        base_persona += """
+STUDY_PERSONA = BASE_PERSONA + """
         📚 STUDY & LEARN MODE ACTIVATED:
         - Act as an expert tutor.
         - Break down complex topics into easy-to-understand, bite-sized pieces.
@@ -87,7 +228,83 @@ def ask_ai():
         - Provide analogies and real-world examples.
         """
 
-    last_user_msg = next((m["content"] for m in reversed(history) if m["role"] == "user"), "")
+SEARCH_MODE_SUFFIX = "\n🌍 SEARCH MODE ON: Use google_search tool. Cite sources cleanly."
+
+# (study mode, search mode) -> full persona text; search mode only ever applies to Gemini
+PERSONAS = {
+    (study, search): (STUDY_PERSONA if study else BASE_PERSONA) + (SEARCH_MODE_SUFFIX if search else "")
+    for study in (False, True)
+    for search in (False, True)
+}
+GOOGLE_SEARCH_TOOLS = [{"google_search": {}}]
+
+# Gemini calls the assistant "model"; every other role is sent as "user"
+_gemini_role = {"assistant": "model"}.get
+
+# -------------------------------------------------------
+# GEMINI RESPONSE UTILS
+# -------------------------------------------------------
+NO_RESPONSE_TEXT = "I couldn't generate a response."
+
+# Adds grounding citations to the sources dict (uri -> source), keeping the first title per uri
+def collect_sources(meta, sources):
+    for item in chain(meta.get("groundingChunks", []), meta.get("groundingAttributions", [])):
+        web = item.get("web") or {}
+        uri, title = web.get("uri"), web.get("title")
+        if uri and title and uri not in sources:
+            sources[uri] = {"uri": uri, "title": title}
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + orjson.dumps(data) + b"\n\n"
+
+# Relays streamGenerateContent as SSE: {"text": ...} deltas, then a final "sources" event
+def stream_gemini(payload):
+    sources = {}
+    sent_text = False
+    try:
+        with API_SESSION.post(
+            GEMINI_STREAM_URL, headers=GEMINI_HEADERS, data=gemini_body(payload), stream=True
+        ) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                candidate = (orjson.loads(line[5:]).get("candidates") or [{}])[0]
+                text = "".join(p.get("text", "") for p in candidate.get("content", {}).get("parts", []))
+                if text:
+                    sent_text = True
+                    yield sse_event({"text": text})
+                collect_sources(candidate.get("groundingMetadata", {}), sources)
+    except Exception as e:
+        print("GEMINI ERROR:", e)
+        yield sse_event({"text": "Server connection issue."}, event="error")
+        return
+    if not sent_text:
+        # Same fallback as the buffered path, e.g. when the answer was blocked or had no parts
+        yield sse_event({"text": NO_RESPONSE_TEXT})
+    yield sse_event(list(sources.values()), event="sources")
+
+# -------------------------------------------------------
+# MAIN AI ENDPOINT
+# -------------------------------------------------------
+@app.route("/ask", methods=["POST"])
+def ask_ai():
+    data = request.get_json()
+    history = data.get("history", [])
+    
+    # Mode Toggles
+    use_web_search = data.get("useWebSearch", False)
+    use_think_mode = data.get("useThinkMode", False)
+    use_study_mode = data.get("useStudyMode", False)
+
+    persona = PERSONAS[bool(use_study_mode), bool(use_web_search and not use_think_mode)]
+
+    # The frontend sends the current user turn last, so only scan back when it doesn't
+    if history and history[-1]["role"] == "user":
+        last_user_msg = history[-1]["content"]
+    else:
+        last_user_msg = next((m["content"] for m in reversed(history) if m["role"] == "user"), "")
     found_url = extract_url(last_user_msg)
     
     context_injection = ""
@@ -95,13 +312,13 @@ def ask_ai():
         crawled_text = crawl_specific_url(found_url)
         context_injection = f"\n📄 CONTEXT FROM LINK ({found_url}):\n{crawled_text}\n"
 
-    system_instruction = base_persona + context_injection
+    system_instruction = persona + context_injection
 
     # ===================================================
     # 🧠 DEEPSEEK ROUTING (THINK MODE)
     # ===================================================
     if use_think_mode:
-        if not deepseek_api_key:
+        if not DEEPSEEK_API_KEY:
             return jsonify({"error": "Server missing DeepSeek API Key"}), 500
 
         ds_messages = [{"role": "system", "content": system_instruction}]
@@ -109,17 +326,14 @@ def ask_ai():
             ds_messages.append({"role": item["role"], "content": item["content"]})
 
         url = "https://api.deepseek.com/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {deepseek_api_key}"
-        }
+        headers = {**JSON_HEADERS, "Authorization": f"Bearer {DEEPSEEK_API_KEY}"}
         payload = {"model": "deepseek-reasoner", "messages": ds_messages}
 
         start_time = time.time()
         try:
-            resp = requests.post(url, headers=headers, json=payload)
+            resp = API_SESSION.post(url, headers=headers, data=orjson.dumps(payload))
             resp.raise_for_status()
-            ds_data = resp.json()
+            ds_data = orjson.loads(resp.content)
             
             end_time = time.time()
             think_time = round(end_time - start_time, 2)
@@ -138,69 +352,88 @@ def ask_ai():
     # ===================================================
     # ⚡ GEMINI 2.5 FLASH ROUTING (DEFAULT / WEB SEARCH)
     # ===================================================
-    if not gemini_api_key:
+    if not GEMINI_API_KEY:
         return jsonify({"error": "Server missing Gemini API Key"}), 500
 
-    tools = []
-    if use_web_search:
-        system_instruction += "\n🌍 SEARCH MODE ON: Use google_search tool. Cite sources cleanly."
-        tools = [{"google_search": {}}]
-
-    gemini_contents = []
-    for item in history:
-        role = "model" if item["role"] == "assistant" else "user"
-        gemini_contents.append({"role": role, "parts": [{"text": item["content"]}]})
+    gemini_contents = [
+        {"role": _gemini_role(item["role"], "user"), "parts": [{"text": item["content"]}]}
+        for item in history if item.get("content")
+    ]
 
     payload = {
         "contents": gemini_contents,
         "systemInstruction": {"parts": [{"text": system_instruction}]}
     }
-    if tools:
-        payload["tools"] = tools
+    if use_web_search:
+        payload["tools"] = GOOGLE_SEARCH_TOOLS
+
+    if data.get("stream"):
+        return Response(stream_gemini(payload), mimetype="text/event-stream")
 
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
     try:
-        resp = requests.post(
-            url, headers={"Content-Type": "application/json"},
-            params={"key": gemini_api_key}, json=payload
-        )
+        resp = API_SESSION.post(GEMINI_URL, headers=GEMINI_HEADERS, data=gemini_body(payload))
         resp.raise_for_status()
-        result = resp.json()
-        
-        candidate = result.get("candidates", [{}])[0]
+        # Read the whole body so the connection goes back to the keep-alive pool
+        candidate = (orjson.loads(resp.content).get("candidates") or [{}])[0]
+
         parts = candidate.get("content", {}).get("parts", [])
-        answer = parts[0].get("text", "") if parts else "I couldn't generate a response."
+        answer = parts[0].get("text", "") if parts else NO_RESPONSE_TEXT
 
-        sources = []
-        meta = candidate.get("groundingMetadata", {})
-        for item in meta.get("groundingChunks", []) + meta.get("groundingAttributions", []):
-            web = item.get("web", {})
-            if web.get("uri") and web.get("title"):
-                sources.append({"uri": web["uri"], "title": web["title"]})
-        unique_sources = list({v["uri"]: v for v in sources}.values())
+        sources = {}
+        collect_sources(candidate.get("groundingMetadata", {}), sources)
 
-        return jsonify({"answer": answer, "sources": unique_sources})
+        return jsonify({"answer": answer, "sources": list(sources.values())})
 
     except Exception as e:
         print("GEMINI ERROR:", e)
         return jsonify({"answer": "Server connection issue.", "sources": []})
 
 
+# Prompts this short already read like a title, so skip the Gemini round-trip
+SHORT_TITLE_CHARS = 60
+_TITLE_WORD_RE = re.compile(r"[\w'’-]+")
+
+# sha256(prompt) -> title, oldest entry first. Keyed by digest because long first turns are
+# often pasted documents, and holding 1024 of those per worker would be unbounded memory.
+_title_cache = OrderedDict()
+_title_lock = Lock()
+TITLE_CACHE_SIZE = 1024
+
+def _gemini_title(prompt):
+    digest = hashlib.sha256(prompt.encode()).digest()
+    with _title_lock:
+        title = _title_cache.get(digest)
+        if title is not None:
+            _title_cache.move_to_end(digest)
+            return title
+    # Raises on failure, so errors are never cached
+    payload = {"contents": [{"parts": [{"text": f"Summarize this into a short 3–4 word title: {prompt}"}]}]}
+    resp = API_SESSION.post(GEMINI_URL, headers=GEMINI_HEADERS, data=gemini_body(payload))
+    resp.raise_for_status()
+    title = orjson.loads(resp.content)["candidates"][0]["content"]["parts"][0]["text"]
+    with _title_lock:
+        _title_cache[digest] = title
+        while len(_title_cache) > TITLE_CACHE_SIZE:
+            _title_cache.popitem(last=False)
+    return title
+
 @app.route("/generate-title", methods=["POST"])
 def generate_title():
     data = request.get_json()
     prompt = data.get("prompt", "")
-    key = os.getenv("GEMINI_API_KEY")
-    if not prompt or not key:
+    if not prompt:
+        return jsonify({"title": "New Chat"})
+    if len(prompt) <= SHORT_TITLE_CHARS:
+        words = _TITLE_WORD_RE.findall(prompt)[:5]
+        return jsonify({"title": " ".join(w[:1].upper() + w[1:] for w in words) or "New Chat"})
+    if not GEMINI_API_KEY:
         return jsonify({"title": "New Chat"})
     try:
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
-        payload = {"contents": [{"parts": [{"text": f"Summarize this into a short 3–4 word title: {prompt}"}]}]}
-        resp = requests.post(url, params={"key": key}, json=payload)
-        return jsonify({"title": resp.json()["candidates"][0]["content"]["parts"][0]["text"]})
+        return jsonify({"title": _gemini_title(prompt)})
     except:
         return jsonify({"title": "New Chat"})
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(host="0.0.0.0", port=5000, debug=os.getenv("FLASK_DEBUG") == "1")
\ No newline at end of file
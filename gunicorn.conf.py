@@ -0,0 +1,10 @@
+import multiprocessing
+import os
+
+# /ask spends nearly all its time waiting on Gemini/DeepSeek, so use cooperative gevent workers.
+# The gevent worker monkey-patches sockets itself, which makes requests cooperative too.
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_connections = 1000
+keepalive = 75
+timeout = 120